@@ -21,7 +21,12 @@ import logging
 from logging import info, error
 import os
 import csv
+import contextlib
 import datetime
+import functools
+import mmap
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from glob import glob
 
 import numpy as np
@@ -34,10 +39,12 @@ from astropy.io import fits
 # directory with fits images per channel for Stokes IQUV.
 DIR_IMAGES = "images/"
 
-PATHLIST_STOKESI = sorted(glob(DIR_IMAGES + "*.I.im-image.fits"))
-PATHLIST_STOKESQ = sorted(glob(DIR_IMAGES + "*.Q.im-image.fits"))
-PATHLIST_STOKESU = sorted(glob(DIR_IMAGES + "*.U.im-image.fits"))
-PATHLIST_STOKESV = sorted(glob(DIR_IMAGES + "*.V.im-image.fits"))
+# scan the directory once and split the images by Stokes parameter
+PATHLIST_IMAGES = sorted(glob(DIR_IMAGES + "*.im-image.fits"))
+PATHLIST_STOKESI = [p for p in PATHLIST_IMAGES if p.endswith(".I.im-image.fits")]
+PATHLIST_STOKESQ = [p for p in PATHLIST_IMAGES if p.endswith(".Q.im-image.fits")]
+PATHLIST_STOKESU = [p for p in PATHLIST_IMAGES if p.endswith(".U.im-image.fits")]
+PATHLIST_STOKESV = [p for p in PATHLIST_IMAGES if p.endswith(".V.im-image.fits")]
 
 OBJECT_NAME = os.path.basename(PATHLIST_STOKESI[0].split(".")[0])
 CUBE_NAME = "cube." + OBJECT_NAME + ".fits"
@@ -51,6 +58,17 @@ RMS_THRESHOLD = RMS_THRESHOLD * 1e-6  # to [Jy/beam], don't change this!
 WRITE_STATISTICS_FILE = True
 FILEPATH_STATISTICS = "rms-noise-statistics.tab"
 
+# Estimate the RMS noise from a fixed random subsample of this many pixels per
+# image. Images with fewer pixels are used completely. Set it to 0 to always
+# use all pixels.
+MAD_SAMPLE_SIZE = 1 << 17
+
+# number of channels that are processed in parallel. This is also the number of
+# concurrent file reads and cube writes, keep it moderate on shared filesystems.
+NUMBER_OF_THREADS = 4
+# flush the data cube to disk after this number of processed channels
+FLUSH_INTERVAL = 10
+
 # INPUT
 # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 
@@ -63,10 +81,54 @@ logging.basicConfig(
 )
 SEPERATOR = "-----------------------------------------------------------------"
 
+# per thread scratch buffer for the median computations
+SCRATCH = threading.local()
+
 # SETTINGS
 # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 
 
+def check_pathlists():
+    """
+    Check that the Stokes IQUV path lists line up channel by channel.
+
+    The paths are grouped by channel, i.e. the file name without
+    ".{I,Q,U,V}.im-image.fits". Every channel needs exactly one image per Stokes
+    parameter and entry i of every PATHLIST_STOKES* list has to belong to the
+    same channel.
+
+    """
+    suffix = ".im-image.fits"
+    pathlists = {
+        "I": PATHLIST_STOKESI,
+        "Q": PATHLIST_STOKESQ,
+        "U": PATHLIST_STOKESU,
+        "V": PATHLIST_STOKESV,
+    }
+    channels = {}
+    for stokes, pathlist in pathlists.items():
+        for filePathFits in pathlist:
+            channel = filePathFits[: -len("." + stokes + suffix)]
+            channels.setdefault(channel, []).append(stokes)
+    incomplete = [
+        "%s (%s)" % (channel, "".join(stokesList))
+        for channel, stokesList in sorted(channels.items())
+        if stokesList != list("IQUV")
+    ]
+    if incomplete:
+        raise ValueError(
+            "Channels without exactly one image per Stokes IQUV: %s"
+            % ", ".join(incomplete)
+        )
+    channelLists = [
+        [filePathFits[: -len("." + stokes + suffix)] for filePathFits in pathlist]
+        for stokes, pathlist in pathlists.items()
+    ]
+    if any(channelList != channelLists[0] for channelList in channelLists):
+        raise ValueError("Stokes IQUV path lists are not in the same channel order")
+    info("Found %d channels with Stokes IQUV images.", len(channels))
+
+
 def get_and_add_custom_header(header):
     """
     Gets header from fits file and updates the cube header.
@@ -105,7 +167,8 @@ def make_empty_image():
     info(SEPERATOR)
     info("Getting image dimension for data cube from: %s", PATHLIST_STOKESI[0])
     with fits.open(PATHLIST_STOKESI[0], memmap=True) as hud:
-        xdim, ydim = np.squeeze(hud[0].data).shape
+        # numpy order is (NAXIS2, NAXIS1)
+        ydim, xdim = np.squeeze(hud[0].data).shape
     info("X-dimension: %s", xdim)
     info("Y-dimension: %s", ydim)
 
@@ -129,8 +192,14 @@ def make_empty_image():
 
     header = hdu.header
     header = get_and_add_custom_header(header)
+    header["NAXIS"] = len(dims)
     for i, dim in enumerate(dims, 1):
         header["NAXIS%d" % i] = dim
+    # The header comes from a channel image, but the cube data is always
+    # written as unscaled big-endian float32.
+    header["BITPIX"] = -32
+    header.remove("BSCALE", ignore_missing=True)
+    header.remove("BZERO", ignore_missing=True)
 
     header.tofile(CUBE_NAME, overwrite=True)
 
@@ -139,23 +208,86 @@ def make_empty_image():
     header_size = len(
         header.tostring()
     )  # Probably 2880. We don't pad the header any more; it's just the bare minimum
-    data_size = np.product(dims) * np.dtype(np.float32).itemsize
+    # int64 product, the default integer of np.prod is 32 bit on some platforms
+    data_size = int(np.prod(dims, dtype=np.int64)) * np.dtype(np.float32).itemsize
     # This is not documented in the example, but appears to be Astropy's default behaviour
     # Pad the total file size to a multiple of the header block size
     block_size = 2880
-    data_size = block_size * ((data_size // block_size) + 1)
+    data_size = block_size * ((data_size + block_size - 1) // block_size)
 
     with open(CUBE_NAME, "rb+") as f:
         f.seek(header_size + data_size - 1)
         f.write(b"\0")
 
 
+def get_scratch_buffer(size, dtype):
+    """
+    Get a flat scratch buffer that is private to the calling thread.
+
+    The buffer is reused as long as size and dtype do not change, which avoids
+    allocating a full plane for every median computation.
+
+    Parameters
+    ----------
+    size: int
+       Number of elements of the buffer
+    dtype: numpy.dtype
+       Data type of the buffer
+
+    Returns
+    -------
+    buffer: numpy.array
+       Flat scratch buffer
+
+    """
+    buffer = getattr(SCRATCH, "buffer", None)
+    if buffer is None or buffer.size != size or buffer.dtype != dtype:
+        buffer = np.empty(size, dtype=dtype)
+        SCRATCH.buffer = buffer
+    return buffer
+
+
+def get_median_inplace(buffer, size):
+    """
+    Compute the median of a flat array in place.
+
+    Selects with np.partition like np.median does and gives the same result,
+    but partitions buffer itself instead of a copy, so a reused scratch buffer
+    needs no further allocation. The order of the elements in buffer gets
+    changed. np.partition sorts nan to the end, so the median of the first size
+    elements is the median of the values that are not nan.
+
+    Parameters
+    ----------
+    buffer: numpy.array
+       Flat array of which the median gets calculated from
+    size: int
+       Number of elements in buffer that are not nan
+
+    Returns
+    -------
+    median: float
+       Median of the elements in buffer that are not nan
+
+    """
+    k = size // 2
+    if size % 2:
+        buffer.partition(k)
+        return buffer[k]
+    buffer.partition([k - 1, k])
+    return 0.5 * (buffer[k - 1] + buffer[k])
+
+
 def get_mad(a, axis=None):
     """
     Compute *Median Absolute Deviation* of an array along given axis.
 
     from: https://informatique-python.readthedocs.io/fr/latest/Exercices/mad.html
 
+    For axis=None both medians are computed in place in a reused per thread
+    scratch buffer instead of copies of a, and nan values (e.g. blanked image
+    borders) are ignored.
+
     Parameters
     ----------
     a: numpy.array
@@ -167,17 +299,56 @@ def get_mad(a, axis=None):
        MAD from a
 
     """
+    if axis is None:
+        a = np.ravel(a)
+        buffer = get_scratch_buffer(a.size, a.dtype.newbyteorder("="))
+        np.copyto(buffer, a)
+        size = buffer.size - np.count_nonzero(np.isnan(buffer))
+        if size == 0:
+            return np.nan
+        med = get_median_inplace(buffer, size)
+        np.subtract(a, med, out=buffer)
+        np.absolute(buffer, out=buffer)
+        return get_median_inplace(buffer, size)
+
     # Median along given axis, but *keeping* the reduced axis so that
     # result can still broadcast against a.
     med = np.median(a, axis=axis, keepdims=True)
-    mad = np.median(np.absolute(a - med), axis=axis)  # MAD along given axis
+    # |a - med| in a single temporary that np.median may then partition in place
+    deviation = np.subtract(a, med)
+    np.absolute(deviation, out=deviation)
+    mad = np.median(deviation, axis=axis, overwrite_input=True)  # MAD along axis
     return mad
 
 
+@functools.lru_cache(maxsize=None)
+def get_sample_indices(size):
+    """
+    Get sorted random pixel indices for the subsampled MAD estimate.
+
+    The indices are drawn with a fixed seed and cached per image size, so every
+    image of the same size is sampled at the same pixels.
+
+    Parameters
+    ----------
+    size: int
+       Number of pixels of the image
+
+    Returns
+    -------
+    indices: numpy.array
+       Sorted array with MAD_SAMPLE_SIZE indices into the flattened image
+
+    """
+    rng = np.random.default_rng(0)
+    return np.sort(rng.integers(0, size, size=MAD_SAMPLE_SIZE))
+
+
 def get_std_via_mad(npArray):
     """
     Estimate standard deviation via Median Absolute Deviation.
 
+    Images with more than MAD_SAMPLE_SIZE pixels are subsampled.
 
     Parameters
     ----------
@@ -190,6 +361,9 @@ def get_std_via_mad(npArray):
        Standard Deviation from MAD
 
     """
+    npArray = np.ravel(npArray)
+    if MAD_SAMPLE_SIZE and npArray.size > MAD_SAMPLE_SIZE:
+        npArray = npArray[get_sample_indices(npArray.size)]
     mad = get_mad(npArray)
     std = 1.4826 * mad
     # std = round(std, 3)
@@ -201,8 +375,8 @@ def check_rms(npArray):
     """
     Check if the Numpy Array is below RMS_THRESHOLD and above 1e-6 uJy/beam.
 
-    If the Numpy Array is not within the range it gets assigned to not a number
-    (np.nan).
+    If the Numpy Array is not within the range, or its RMS noise is nan (e.g. a
+    fully blanked image), None is returned instead of the Numpy Array.
 
     Parameters
     ----------
@@ -211,94 +385,377 @@ def check_rms(npArray):
 
     Returns
     -------
-    [npArray, std]: list with numpy.array and float
-       List of length 2 with  the Numpy Array and the Standard Deviation
+    [npArray, std]: list with numpy.array or None and float
+       List of length 2 with  the Numpy Array (None if rejected) and the
+       Standard Deviation
 
     """
     std = get_std_via_mad(npArray)
-    if (std > RMS_THRESHOLD) or (std < 1e-6):
-        npArray = np.nan
+    if not (1e-6 <= std <= RMS_THRESHOLD):
+        npArray = None
     return [npArray, std]
 
 
-def write_statistics_file(rmsDict):
+def write_statistics_row(writer, rmsI, rmsV):
+    """
+    Writes the Stokes I and V RMS noise of one channel to the statistics file.
+
+    Parameters
+    ----------
+    writer: csv.writer or None
+       Writer of the statistics file, nothing gets written if None
+    rmsI: float
+       Stokes I RMS noise in [Jy/beam], np.nan for flagged channels
+    rmsV: float
+       Stokes V RMS noise in [Jy/beam]
+
+    """
+    if writer is None:
+        return
+    writer.writerow(["%.4f" % (rmsI * 1e6), "%.4f" % (rmsV * 1e6)])
+
+
+def get_image_layout():
+    """
+    Get the layout of the data block of the channel images.
+
+    All channel images are assumed to share the header size, data type and
+    shape of the first image in PATHLIST_STOKESI, so only that one gets parsed.
+    Only unscaled floating point images with a single 2 dimensional plane are
+    supported.
+
+    Returns
+    -------
+    imageLayout: dict
+       Dictionary with the byte offset of the data block ("offset"), the on disk
+       data type ("dtype"), the 2 dimensional image shape ("shape") and the
+       expected size of the fits files in bytes ("filesize")
+
+    """
+    with fits.open(
+        PATHLIST_STOKESI[0], memmap=True, do_not_scale_image_data=True
+    ) as hud:
+        header = hud[0].header
+        if header["BITPIX"] > 0:
+            raise ValueError("Integer images are not supported: %s" % hud.filename())
+        if header.get("BSCALE", 1) != 1 or header.get("BZERO", 0) != 0:
+            raise ValueError("Scaled images are not supported: %s" % hud.filename())
+        if np.prod(hud[0].data.shape[:-2]) != 1:
+            raise ValueError("Image has more than one plane: %s" % hud.filename())
+        fileInfo = hud.fileinfo(0)
+        imageLayout = {}
+        imageLayout["offset"] = fileInfo["datLoc"]
+        imageLayout["dtype"] = hud[0].data.dtype
+        imageLayout["shape"] = hud[0].data.shape[-2:]
+        imageLayout["filesize"] = fileInfo["datLoc"] + fileInfo["datSpan"]
+    return imageLayout
+
+
+def read_plane(filePathFits, imageLayout, out=None):
+    """
+    Read the image of a channel fits file without parsing its header.
+
+    The header is only checked via the file size, which has to match the layout
+    of the first image.
+
+    If out has the on disk data type of the image, the data block is read
+    straight into it, e.g. into a slice of the memory mapped cube, without an
+    intermediate array. Where available the kernel is told that the file is
+    read once and sequentially.
+
+    Parameters
+    ----------
+    filePathFits: str
+       Path to the fits file
+    imageLayout: dict
+       Layout of the data block as returned by get_image_layout
+    out: numpy.array
+       Optional C-contiguous 2 dimensional array the image gets written to
+
+    Returns
+    -------
+    npArray: numpy.array
+       The 2 dimensional image data
+
+    """
+    info("Reading fits file: %s", filePathFits)
+    if out is None or out.dtype != imageLayout["dtype"]:
+        npArray = np.empty(imageLayout["shape"], dtype=imageLayout["dtype"])
+    else:
+        npArray = out
+    with open(filePathFits, "rb") as f:
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_NOREUSE)
+        if os.fstat(f.fileno()).st_size != imageLayout["filesize"]:
+            raise ValueError(
+                "Fits file does not match the layout of %s: %s"
+                % (PATHLIST_STOKESI[0], filePathFits)
+            )
+        f.seek(imageLayout["offset"])
+        nBytes = f.readinto(npArray)
+    if nBytes != npArray.nbytes:
+        raise ValueError("Truncated data block in fits file: %s" % filePathFits)
+    if out is not None and npArray is not out:
+        np.copyto(out, npArray)
+        npArray = out
+    return npArray
+
+
+def prefetch_planes(filePathList, imageLayout):
+    """
+    Ask the kernel to start reading the data blocks of fits files in background.
+
+    The files get read into the page cache asynchronously, so later calls of
+    read_plane do not wait for the disk. Does nothing on platforms without
+    os.posix_fadvise.
+
+    Parameters
+    ----------
+    filePathList: list of str
+       Paths to the fits files
+    imageLayout: dict
+       Layout of the data block as returned by get_image_layout
+
+    """
+    if not hasattr(os, "posix_fadvise"):
+        return
+    nBytes = int(np.prod(imageLayout["shape"])) * imageLayout["dtype"].itemsize
+    for filePathFits in filePathList:
+        with open(filePathFits, "rb") as f:
+            os.posix_fadvise(
+                f.fileno(), imageLayout["offset"], nBytes, os.POSIX_FADV_WILLNEED
+            )
+
+
+def advise_cube(dataCube, advice, firstChannel=0, lastChannel=None):
     """
-    Takes the dictionary with Stokes I and V RMS noise and writes it to a file.
+    Give the kernel a madvise hint for channels of the memory mapped cube.
+
+    The hint is applied to the pages that lie completely within the channels
+    firstChannel to lastChannel (exclusive) of every Stokes plane. Does nothing
+    on platforms without madvise.
 
     Parameters
     ----------
-    rmdDict: dict of lists with floats
-       Dictionary with lists for Stokes I and V rms noise
+    dataCube: numpy.memmap
+       The memory mapped data cube
+    advice: str
+       Name of the mmap.MADV_* constant, e.g. "MADV_SEQUENTIAL"
+    firstChannel: int
+       First channel of the range
+    lastChannel: int
+       Channel after the last channel of the range, defaults to all channels
 
     """
-    legendList = ["RMS Stokes I [uJy/beam]", "RMS Sokes V [uJy/beam]"]
-    info("Writing statistics file: %s", FILEPATH_STATISTICS)
-    with open(FILEPATH_STATISTICS, "w") as csvFile:
-        writer = csv.writer(csvFile, delimiter="\t")
-        csvData = [legendList]
-        for i, entry in enumerate(rmsDict["rmsI"]):
-            rmsI = round(rmsDict["rmsI"][i] * 1e6, 4)
-            rmsV = round(rmsDict["rmsV"][i] * 1e6, 4)
-            csvData.append([rmsI, rmsV])
-        writer.writerows(csvData)
+    if not hasattr(mmap, advice):
+        return
+    wdim, zdim = dataCube.shape[:2]
+    if lastChannel is None:
+        lastChannel = zdim
+    planeSize = dataCube[0, 0].nbytes
+    # np.memmap maps from the offset rounded down to ALLOCATIONGRANULARITY
+    dataStart = dataCube.offset % mmap.ALLOCATIONGRANULARITY
+    for w in range(wdim):
+        start = dataStart + (w * zdim + firstChannel) * planeSize
+        end = dataStart + (w * zdim + lastChannel) * planeSize
+        start = -(-start // mmap.PAGESIZE) * mmap.PAGESIZE
+        end = (end // mmap.PAGESIZE) * mmap.PAGESIZE
+        if end > start:
+            dataCube._mmap.madvise(getattr(mmap, advice), start, end - start)
+
+
+def process_stokes_v(i, dataCube, imageLayout):
+    """
+    Fills the Stokes V plane of one channel and checks its RMS noise.
+
+    If the Stokes V RMS noise is not within the range of check_rms, all Stokes
+    planes of the channel get flagged (np.nan).
+
+    Parameters
+    ----------
+    i: int
+       Index of the channel in the PATHLIST_STOKES* lists
+    dataCube: numpy.array
+       The memory mapped data cube
+    imageLayout: dict
+       Layout of the channel images as returned by get_image_layout
+
+    Returns
+    -------
+    [i, rmsV, stokesVflag]: list with int, float and bool
+       Channel index, RMS noise estimate for Stokes V and whether the channel
+       got flagged
+
+    """
+    # The image is read straight into the cube. A rejected Stokes V plane
+    # gets overwritten by the flagging below.
+    dataV = read_plane(PATHLIST_STOKESV[i], imageLayout, out=dataCube[3, i])
+    checkedArray, rmsV = check_rms(dataV)
+    stokesVflag = checkedArray is None
+
+    if stokesVflag:
+        info(
+            "Stokes V RMS noise of %s [uJy/beam] above RMS_THRESHOLD of %s [uJy/beam]. Flagging Stokes IQUV",
+            str(round(rmsV * 1e6, 2)),
+            str(round(RMS_THRESHOLD * 1e6, 3)),
+        )
+        dataCube[:, i, :, :] = np.nan
+
+    return [i, rmsV, stokesVflag]
+
+
+def process_stokes_iqu(i, dataCube, imageLayout):
+    """
+    Fills the Stokes I, Q and U planes of one channel.
+
+    Stokes Q and U get prefetched while Stokes I is read and its RMS noise is
+    estimated.
+
+    Parameters
+    ----------
+    i: int
+       Index of the channel in the PATHLIST_STOKES* lists
+    dataCube: numpy.array
+       The memory mapped data cube
+    imageLayout: dict
+       Layout of the channel images as returned by get_image_layout
+
+    Returns
+    -------
+    [i, rmsI]: list with int and float
+       Channel index and RMS noise estimate for Stokes I
+
+    """
+    prefetch_planes([PATHLIST_STOKESQ[i], PATHLIST_STOKESU[i]], imageLayout)
+    dataI = read_plane(PATHLIST_STOKESI[i], imageLayout, out=dataCube[0, i])
+    rmsI = get_std_via_mad(dataI)
+    read_plane(PATHLIST_STOKESQ[i], imageLayout, out=dataCube[1, i])
+    read_plane(PATHLIST_STOKESU[i], imageLayout, out=dataCube[2, i])
+    return [i, rmsI]
+
+
+def process_channels(function, channels, dataCube, imageLayout):
+    """
+    Runs function for the given channels with NUMBER_OF_THREADS threads.
+
+    Each channel writes to its own slices of the data cube, so channels can be
+    processed in parallel. Every FLUSH_INTERVAL channels the cube gets flushed
+    and the pages of the finished channels are released.
+
+    Parameters
+    ----------
+    function: callable
+       Called as function(i, dataCube, imageLayout), returning a list that
+       starts with i
+    channels: list of int
+       Ascending channel indices
+    dataCube: numpy.memmap
+       The memory mapped data cube
+    imageLayout: dict
+       Layout of the channel images as returned by get_image_layout
+
+    Yields
+    ------
+    result: list
+       Return value of function, in the order of channels
+
+    """
+    firstChannel = 0
+    with ThreadPoolExecutor(max_workers=NUMBER_OF_THREADS) as executor:
+        results = executor.map(
+            function,
+            channels,
+            itertools.repeat(dataCube),
+            itertools.repeat(imageLayout),
+        )
+        for nDone, result in enumerate(results, 1):
+            if nDone % FLUSH_INTERVAL == 0:
+                # results are in order, so all channels up to this one are done
+                lastChannel = result[0] + 1
+                dataCube.flush()
+                advise_cube(dataCube, "MADV_DONTNEED", firstChannel, lastChannel)
+                firstChannel = lastChannel
+            yield result
 
 
 def fill_cube_with_images():
     """
     Fills the empty data cube with fits data.
 
+    A first pass fills Stokes V and flags the channels with a bad Stokes V RMS
+    noise. A second pass reads Stokes IQU only for the channels that were not
+    flagged. The channels are processed in parallel with NUMBER_OF_THREADS
+    threads. The data block of the cube is memory mapped directly with numpy,
+    bypassing astropy's update mode. The mapping is advised for sequential
+    access and the pages of finished channels are released every
+    FLUSH_INTERVAL channels. The statistics file is written row by row in
+    channel order during the second pass, a row as soon as the Stokes I RMS
+    noise of its channel is known. The Stokes V estimates of the first pass are
+    only kept in memory, so a crash before the second pass finishes its first
+    kept channel leaves a file with the legend only.
 
     """
     info(SEPERATOR)
     info("Opening data cube: %s", CUBE_NAME)
-    hudCube = fits.open(CUBE_NAME, memmap=True, mode="update")
-    dataCube = hudCube[0].data
-
-    rmsDict = {}
-    rmsDict["rmsI"] = []
-    rmsDict["rmsV"] = []
-    for i, filePathFits in enumerate(PATHLIST_STOKESI):
-        # Switch
-        stokesVflag = False
+    header = fits.getheader(CUBE_NAME)
+    if header["BITPIX"] != -32 or "BSCALE" in header or "BZERO" in header:
+        raise ValueError("Data cube is not unscaled float32: %s" % CUBE_NAME)
+    shape = tuple(header["NAXIS%d" % n] for n in range(header["NAXIS"], 0, -1))
+    dataCube = np.memmap(
+        CUBE_NAME,
+        dtype=">f4",
+        mode="r+",
+        offset=len(header.tostring()),
+        shape=shape,
+    )
+    advise_cube(dataCube, "MADV_SEQUENTIAL")
+    imageLayout = get_image_layout()
+    if tuple(imageLayout["shape"]) != dataCube.shape[2:]:
+        raise ValueError(
+            "Image shape %s does not match the data cube plane shape %s"
+            % (tuple(imageLayout["shape"]), dataCube.shape[2:])
+        )
+
+    nChannels = len(PATHLIST_STOKESI)
+    rmsStokesV = np.full(nChannels, np.nan)
+    keptChannels = []
+
+    with contextlib.ExitStack() as stack:
+        writer = None
+        if WRITE_STATISTICS_FILE:
+            info("Writing statistics file: %s", FILEPATH_STATISTICS)
+            # line buffered, so the rows of the second pass written so far
+            # survive a crash
+            csvFile = stack.enter_context(open(FILEPATH_STATISTICS, "w", buffering=1))
+            writer = csv.writer(csvFile, delimiter="\t")
+            writer.writerow(["RMS Stokes I [uJy/beam]", "RMS Stokes V [uJy/beam]"])
 
         info(SEPERATOR)
-        info("Opening fits file: %s", PATHLIST_STOKESV[i])
-        with fits.open(PATHLIST_STOKESV[i], memmap=True) as hud:
-            checkedArray, std = check_rms(hud[0].data[:, :])
-            rmsDict["rmsV"].append(std)
-            dataCube[3, i, :, :] = checkedArray
-            if np.isnan(np.sum(checkedArray)):
-                stokesVflag = True
-
-        if not stokesVflag:
-            info("Opening fits file: %s", PATHLIST_STOKESI[i])
-            with fits.open(PATHLIST_STOKESI[i], memmap=True) as hud:
-                std = get_std_via_mad(hud[0].data[:, :])
-                rmsDict["rmsI"].append(std)
-                dataCube[0, i, :, :] = hud[0].data[:, :]
-
-            info("Opening fits file: %s", PATHLIST_STOKESQ[i])
-            with fits.open(PATHLIST_STOKESQ[i], memmap=True) as hud:
-                dataCube[1, i, :, :] = hud[0].data[:, :]
-
-            info("Opening fits file: %s", PATHLIST_STOKESU[i])
-            with fits.open(PATHLIST_STOKESV[i], memmap=True) as hud:
-                dataCube[2, i, :, :] = hud[0].data[:, :]
-
-        if stokesVflag:
-            info(
-                "Stokes V RMS noise of %s [uJy/beam] above RMS_THRESHOLD of %s [uJy/beam]. Flagging Stokes IQUV",
-                str(round(rmsDict["rmsV"][-1] * 1e6, 2)),
-                str(round(RMS_THRESHOLD * 1e6, 3)),
-            )
-            dataCube[0, i, :, :] = np.nan
-            dataCube[1, i, :, :] = np.nan
-            dataCube[2, i, :, :] = np.nan
-            dataCube[3, i, :, :] = np.nan
+        info("Filling Stokes V and flagging channels.")
+        for i, rmsV, stokesVflag in process_channels(
+            process_stokes_v, range(nChannels), dataCube, imageLayout
+        ):
+            rmsStokesV[i] = rmsV
+            if not stokesVflag:
+                keptChannels.append(i)
 
-    hudCube.close()
-    if WRITE_STATISTICS_FILE:
-        write_statistics_file(rmsDict)
+        info(SEPERATOR)
+        info("Filling Stokes IQU for %d of %d channels.", len(keptChannels), nChannels)
+        # rows of flagged channels are written when the next kept channel is done
+        nextChannel = 0
+        for i, rmsI in process_channels(
+            process_stokes_iqu, keptChannels, dataCube, imageLayout
+        ):
+            for j in range(nextChannel, i):
+                write_statistics_row(writer, np.nan, rmsStokesV[j])
+            write_statistics_row(writer, rmsI, rmsStokesV[i])
+            nextChannel = i + 1
+        for j in range(nextChannel, nChannels):
+            write_statistics_row(writer, np.nan, rmsStokesV[j])
+
+    dataCube.flush()
+    del dataCube
 
 
 if __name__ == "__main__":
@@ -309,6 +766,7 @@ if __name__ == "__main__":
     info(SEPERATOR)
 
     # call methods
+    check_pathlists()
     make_empty_image()
     fill_cube_with_images()
 